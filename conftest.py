@@ -0,0 +1 @@
+# 저장소 루트를 sys.path에 추가해 pytest 실행 시 spotify_chart 모듈을 불러올 수 있도록 함
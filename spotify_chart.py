@@ -1,59 +1,151 @@
 import spotipy  # Spotify API를 사용하기 위한 라이브러리
 import requests  # HTTP 요청을 보내기 위한 라이브러리
 from spotipy.oauth2 import SpotifyClientCredentials  # Spotify 인증을 위한 모듈
-import pandas as pd  # 데이터 분석 및 CSV 저장을 위한 라이브러리
+import pandas as pd  # 수집 일정 생성을 위한 라이브러리
 import json  # JSON 형식의 데이터 처리를 위한 모듈
+import os  # 파일 경로 처리를 위한 모듈
+import csv  # CSV 파일 저장을 위한 모듈
 import time  # 시간 지연을 위한 모듈
 import random  # 무작위 수 생성을 위한 모듈
 import logging  # 로그 출력을 위한 모듈
+import threading  # 요청 속도 제한의 동기화를 위한 모듈
+from concurrent.futures import ThreadPoolExecutor  # 병렬 수집을 위한 모듈
+from contextlib import nullcontext  # 선택적 파일 저장을 위한 모듈
 from datetime import datetime, timedelta  # 날짜 및 시간 계산을 위한 모듈
 from tqdm import tqdm  # 진행 상황 표시를 위한 모듈
-from typing import List, Dict, Any  # 타입 힌팅을 위한 모듈
+from typing import List, Dict, Any, Optional  # 타입 힌팅을 위한 모듈
 from requests.adapters import HTTPAdapter  # HTTP 어댑터 설정을 위한 모듈
 from urllib3.util.retry import Retry  # 재시도 로직을 설정하기 위한 모듈
 
+try:
+    import pyarrow as pa  # Parquet 저장을 위한 라이브러리 (선택 사항)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # 로그 설정
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 차트 데이터 컬럼 목록과 Parquet 저장 시 사용할 타입 (CSV 헤더 순서)
+CHART_COLUMNS = [
+    ('날짜', 'string'),
+    ('시간', 'string'),
+    ('순위', 'int64'),
+    ('제목', 'string'),
+    ('아티스트', 'string'),
+    ('앨범', 'string'),
+    ('발매일', 'string'),
+    ('장르', 'string'),
+    ('인기도', 'int64'),
+    ('댄스성', 'float64'),
+    ('에너지', 'float64'),
+    ('키', 'int64'),
+    ('템포', 'float64'),
+    ('음향도', 'float64'),
+    ('악기비율', 'float64'),
+    ('라이브성', 'float64'),
+    ('긍정도', 'float64'),
+    ('앨범이미지', 'string'),
+]
+
+CHART_FIELDS = [name for name, _ in CHART_COLUMNS]
+
+# Parquet 저장용 스키마 (pyarrow가 없으면 None)
+CHART_SCHEMA = pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in CHART_COLUMNS]) if pa else None
+
+CHECKPOINT_ROWS = 500  # 중간 저장 간격 (행 수)
+PARQUET_ROW_GROUP_ROWS = 5000  # Parquet 행 그룹 하나에 모아 쓸 행 수
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate  # 초당 충전되는 토큰 수
+        self.capacity = capacity  # 최대 토큰 수 (순간 허용량)
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # 토큰이 생길 때까지 대기한 뒤 하나를 소모
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait_time = (1 - self._tokens) / self.rate
+
+            time.sleep(wait_time)
+
 class SpotifyChartHistory:
-    def __init__(self, client_id: str, client_secret: str, max_retries=5, backoff_factor=1, delay_seconds: int = 2):
+    def __init__(self, client_id: str, client_secret: str, max_retries=5, backoff_factor=1, *,
+                 requests_per_second: float = 8, burst_size: int = 10, max_workers: int = 2,
+                 session: requests.Session = None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.max_retries = max_retries  # 최대 재시도 횟수 설정
         self.backoff_factor = backoff_factor  # 재시도 간격 증가율 설정
-        self.delay_seconds = delay_seconds  # 요청 간 대기 시간 설정
+        self.max_workers = max_workers  # 동시에 수집할 날짜 수 (동시 API 요청 수도 이 값 이하로 유지됨)
+        self._bucket = TokenBucket(rate=requests_per_second, capacity=burst_size)  # 초당 API 요청 수 제한
+        self.session = session or self.create_session(max_retries, backoff_factor)  # 연결을 재사용할 HTTP 세션
         self.sp = self._create_spotify_client()  # Spotify 클라이언트 생성
+        self._genre_cache: Dict[str, list] = {}  # 아티스트 ID별 장르 캐시
+        self._audio_features_cache: Dict[str, dict] = {}  # 트랙 ID별 오디오 특성 캐시
+        # 병렬 수집 시 같은 트랙/아티스트를 두 스레드가 동시에 요청하지 않도록 캐시 확인과 요청을 묶는 잠금
+        self._genre_lock = threading.Lock()
+        self._audio_features_lock = threading.Lock()
 
-    def _create_spotify_client(self):
+    @staticmethod
+    def create_session(max_retries=5, backoff_factor=1) -> requests.Session:
         retry_strategy = Retry(
-            total=self.max_retries,
-            backoff_factor=self.backoff_factor,
+            total=max_retries,
+            backoff_factor=backoff_factor,
             status_forcelist=[429, 500, 502, 503, 504],  # 재시도할 HTTP 상태 코드 목록
             allowed_methods=["GET", "POST"]  # 재시도가 허용된 HTTP 메소드 목록
         )
 
+        # 하나의 커넥션 풀을 공유해 TCP/TLS 연결을 날짜 간에 재사용
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry_strategy))
+
+        return session
+
+    def _create_spotify_client(self):
         auth_manager = SpotifyClientCredentials(
             client_id=self.client_id,
-            client_secret=self.client_secret
+            client_secret=self.client_secret,
+            requests_session=self.session
         )
 
-        session = requests.Session()
-        session.mount("https://", HTTPAdapter(max_retries=retry_strategy))
-        
-        return spotipy.Spotify(auth_manager=auth_manager, requests_timeout=10, requests_session=session)
+        return spotipy.Spotify(auth_manager=auth_manager, requests_timeout=10, requests_session=self.session)
 
     def make_api_request(self, func, *args, **kwargs):
         max_attempts = 5
         base_delay = 2
+        max_wait = 60
 
         for attempt in range(max_attempts):
             try:
+                self._bucket.acquire()
                 return func(*args, **kwargs)
             except spotipy.exceptions.SpotifyException as e:
                 if e.http_status == 429:
-                    retry_after = int(e.headers.get('Retry-After', 5))
-                    wait_time = base_delay * (2 ** attempt) + random.uniform(0, 2)
-                    wait_time = min(wait_time, max(retry_after, 5))
+                    if attempt == max_attempts - 1:
+                        raise e
+
+                    retry_after = int((e.headers or {}).get('Retry-After', 5))
+                    # 최대 대기 시간보다 오래 기다리라고 하면 다시 요청해도 429가 확실하므로 중단
+                    if retry_after > max_wait:
+                        logging.error(f"Retry-After ({retry_after}s) exceeds max wait of {max_wait}s. Giving up.")
+                        raise e
+
+                    # 서버가 요청한 대기 시간보다 짧게 기다리지 않도록 max 사용
+                    wait_time = max(retry_after, base_delay * (2 ** attempt)) + random.uniform(0, 1)
+                    wait_time = min(wait_time, max_wait)
                     logging.warning(f"Rate limit exceeded. Waiting {wait_time} seconds...")
                     time.sleep(wait_time)
                     continue
@@ -69,140 +161,221 @@ class SpotifyChartHistory:
                 raise e
 
     def get_track_genres(self, artist_id: str) -> list:
+        if artist_id in self._genre_cache:
+            return self._genre_cache[artist_id]
+
         try:
             artist = self.make_api_request(self.sp.artist, artist_id)
-            return artist['genres'] if artist else []
-        except:
+            if not artist:
+                return []
+
+            self._genre_cache[artist_id] = artist['genres']
+            return artist['genres']
+        except (spotipy.exceptions.SpotifyException, requests.exceptions.RequestException) as e:
+            logging.warning(f"장르 조회 실패 ({artist_id}): {str(e)}")
             return []
 
+    def prefetch_genres(self, artist_ids: list):
+        # 캐시에 없는 아티스트만 최대 50개 단위로 한 번에 요청
+        with self._genre_lock:
+            missing = [artist_id for artist_id in dict.fromkeys(artist_ids) if artist_id not in self._genre_cache]
+
+            for i in range(0, len(missing), 50):
+                batch_ids = missing[i:i+50]
+                try:
+                    result = self.make_api_request(self.sp.artists, batch_ids)
+                except (spotipy.exceptions.SpotifyException, requests.exceptions.RequestException) as e:
+                    logging.error(f"아티스트 정보 조회 실패: {str(e)}")
+                    continue
+
+                # 조회에 실패한 배치는 캐시에 넣지 않고 get_track_genres의 개별 조회로 넘김
+                if not result:
+                    continue
+
+                for artist in result['artists']:
+                    if artist:
+                        self._genre_cache[artist['id']] = artist['genres']
+
     def get_chart_by_date(self, target_date: datetime) -> list:
+        # 날짜 안의 모든 행에서 같은 값이므로 한 번만 계산
         formatted_date = target_date.strftime('%Y%m%d')
+        time_str = target_date.strftime('%H:%M')
 
         try:
             track_ids = []
+            artist_ids = []
             tracks_info = []
 
-            playlist = self.make_api_request(self.sp.playlist_tracks, '37i9dQZEVXbNxXF4SkHj9F')
+            # 한 페이지(최대 100곡)만 받지 않도록 다음 페이지가 없을 때까지 이어서 요청
+            results = self.make_api_request(self.sp.playlist_tracks, '37i9dQZEVXbNxXF4SkHj9F')
+            items = list(results['items'])
+            while results.get('next'):
+                results = self.make_api_request(self.sp.next, results)
+                items.extend(results['items'])
 
-            for idx, item in enumerate(playlist['items'], 1):
+            for idx, item in enumerate(items, 1):
                 track = item['track']
                 track_ids.append(track['id'])
+                artist_ids.append(track['artists'][0]['id'])
                 tracks_info.append({'idx': idx, 'track': track})
 
+            # 캐시에 없는 트랙의 오디오 특성만 최대 100개 ID 단위로 한 번에 요청
+            # 같은 트랙이 여러 번 나와도 한 번만 요청 (순서 유지)
+            unique_ids = list(dict.fromkeys(track_ids))
+            with self._audio_features_lock:
+                missing = [track_id for track_id in unique_ids if track_id not in self._audio_features_cache]
+                for i in range(0, len(missing), 100):
+                    batch_ids = missing[i:i+100]
+                    features_batch = self.make_api_request(self.sp.audio_features, batch_ids)
+                    self._audio_features_cache.update(zip(batch_ids, features_batch))
+
+            audio_features = [self._audio_features_cache[track_id] for track_id in track_ids]
+
+            self.prefetch_genres(artist_ids)
+
             chart_data = []
 
-            for i in range(0, len(track_ids), 100):
-                batch_ids = track_ids[i:i+100]
-                audio_features_batch = self.make_api_request(self.sp.audio_features, batch_ids)
-                
-                time.sleep(self.delay_seconds)
-                
-                for j, features in enumerate(audio_features_batch):
-                    if not features:
-                        continue
-                    
-                    track_info = tracks_info[i+j]
-                    track = track_info['track']
-                    artist_id = track['artists'][0]['id']
-                    
-                    time.sleep(1)
-                    
-                    genres = self.get_track_genres(artist_id)
-                    
-                    chart_data.append({
-                        '날짜': formatted_date,
-                        '시간': target_date.strftime('%H:%M'),
-                        '순위': track_info['idx'],
-                        '제목': track['name'],
-                        '아티스트': ', '.join([artist['name'] for artist in track['artists']]),
-                        '앨범': track['album']['name'],
-                        '발매일': track['album']['release_date'],
-                        '장르': ', '.join(genres) if genres else 'Unknown',
-                        '인기도': track['popularity'],
-                        '댄스성': features['danceability'],
-                        '에너지': features['energy'],
-                        '키': features['key'],
-                        '템포': features['tempo'],
-                        '음향도': features['acousticness'],
-                        '악기비율': features['instrumentalness'],
-                        '라이브성': features['liveness'],
-                        '긍정도': features['valence'],
-                        '앨범이미지': track['album']['images'][0]['url'] if track['album']['images'] else None,
-                    })
-            
+            for track_info, features in zip(tracks_info, audio_features):
+                if not features:
+                    continue
+
+                track = track_info['track']
+                artist_id = track['artists'][0]['id']
+                genres = self.get_track_genres(artist_id)
+
+                chart_data.append({
+                    '날짜': formatted_date,
+                    '시간': time_str,
+                    '순위': track_info['idx'],
+                    '제목': track['name'],
+                    '아티스트': ', '.join([artist['name'] for artist in track['artists']]),
+                    '앨범': track['album']['name'],
+                    '발매일': track['album']['release_date'],
+                    '장르': 'Unknown' if not genres else ', '.join(genres),
+                    '인기도': track['popularity'],
+                    '댄스성': features['danceability'],
+                    '에너지': features['energy'],
+                    '키': features['key'],
+                    '템포': features['tempo'],
+                    '음향도': features['acousticness'],
+                    '악기비율': features['instrumentalness'],
+                    '라이브성': features['liveness'],
+                    '긍정도': features['valence'],
+                    '앨범이미지': track['album']['images'][0]['url'] if track['album']['images'] else None,
+                })
+
             return chart_data
         
         except Exception as e:
             logging.error(f"차트 데이터 수집 실패: {str(e)}")
             return []
 
-    def get_charts_by_period(self, start_date: datetime, end_date: datetime, interval: str = 'hour') -> List[Dict[str, Any]]:
-        all_charts = []
+    @staticmethod
+    def build_schedule(start_date: datetime, end_date: datetime, interval: str = 'hour') -> List[datetime]:
+        # 월/연 단위는 매번 시작 시각에서 i개월(년)을 더해 계산
+        # 앞 날짜에 누적해서 더하면 말일이 당겨진 뒤(1/31 -> 2/29 -> 3/29 ...) 되돌아오지 않음
+        calendar_offsets = {
+            'month': lambda i: pd.DateOffset(months=i),
+            'year': lambda i: pd.DateOffset(years=i),
+        }
         
-        current_date = start_date
+        if interval in calendar_offsets:
+            offset = calendar_offsets[interval]
+            start = pd.Timestamp(start_date)
+            dates = []
+            i = 0
+            while (current_date := start + offset(i)) <= end_date:
+                dates.append(current_date.to_pydatetime())
+                i += 1
+            return dates
         
         interval_timedelta = {
             'hour': timedelta(hours=1),
             'day': timedelta(days=1),
             'week': timedelta(weeks=1),
-            'month': timedelta(days=30),
-            'year': timedelta(days=365),
         }
         
-        delta = interval_timedelta.get(interval, timedelta(hours=1))
+        freq = interval_timedelta.get(interval, timedelta(hours=1))
+        
+        return list(pd.date_range(start_date, end_date, freq=freq).to_pydatetime())
+    
+    def get_charts_by_period(self, start_date: datetime, end_date: datetime, interval: str = 'hour',
+                             output_file: str = 'spotify_charts.csv', parquet_file: str = None) -> int:
+        # 전체 기간을 메모리에 모으지 않고 날짜별로 CSV에 바로 기록
+        total_rows = 0
+        rows_since_save = 0  # 마지막 중간 저장 이후 수집된 행 수
+        
+        if parquet_file and pa is None:
+            logging.warning(f"pyarrow가 설치되어 있지 않아 Parquet 파일을 저장하지 않습니다: {parquet_file}")
+            parquet_file = None
         
-        total_iterations = int((end_date - start_date) / delta) + 1
+        # 중간 데이터는 CSV와 같은 이름의 NDJSON 파일에 한 줄에 한 행씩 기록
+        checkpoint_file = os.path.splitext(output_file)[0] + '.ndjson'
         
-        with tqdm(total=total_iterations, desc=f"{interval} 단위 차트 데이터 수집") as pbar:
+        # 전체 수집 일정을 한 번에 생성
+        dates = self.build_schedule(start_date, end_date, interval)
+        
+        with open(output_file, 'w', newline='', encoding='utf-8-sig') as f, \
+                open(checkpoint_file, 'w', encoding='utf-8') as checkpoint_fp, \
+                (pq.ParquetWriter(parquet_file, CHART_SCHEMA) if parquet_file else nullcontext()) as parquet_writer, \
+                tqdm(total=len(dates), desc=f"{interval} 단위 차트 데이터 수집") as pbar, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            
+            writer = csv.DictWriter(f, fieldnames=CHART_FIELDS)
+            writer.writeheader()
             
-            while current_date <= end_date:
+            # 날짜마다 쓰면 50행짜리 행 그룹이 수천 개 생기므로 모아서 기록
+            parquet_rows = []
+            
+            # map은 제출 순서대로 결과를 돌려주므로 날짜 순서가 유지됨
+            for current_date, daily_chart in zip(dates, executor.map(self.get_chart_by_date, dates)):
                 
-                daily_chart = self.get_chart_by_date(current_date)
+                writer.writerows(daily_chart)
+                f.flush()
                 
-                all_charts.extend(daily_chart)
+                if parquet_writer is not None:
+                    parquet_rows.extend(daily_chart)
+                    if len(parquet_rows) >= PARQUET_ROW_GROUP_ROWS:
+                        parquet_writer.write_table(pa.Table.from_pylist(parquet_rows, schema=CHART_SCHEMA))
+                        parquet_rows = []
                 
-                if len(all_charts) % 100 == 0:
-                    
-                    self.save_intermediate_data(all_charts, current_date)
+                self.save_intermediate_data(checkpoint_fp, daily_chart)
+                total_rows += len(daily_chart)
+                rows_since_save += len(daily_chart)
+                
+                # 행 수의 우연한 배수가 아니라 누적된 행 수 기준으로 저장
+                if rows_since_save >= CHECKPOINT_ROWS:
                     
-                current_date += delta
+                    checkpoint_fp.flush()
+                    rows_since_save = 0
+                    logging.info(f"중간 데이터 저장 완료: {checkpoint_file} ({current_date.strftime('%Y%m%d_%H%M')})")
                 
                 pbar.update(1)
+            
+            if parquet_writer is not None and parquet_rows:
+                parquet_writer.write_table(pa.Table.from_pylist(parquet_rows, schema=CHART_SCHEMA))
         
-        return all_charts
+        return total_rows
     
-    def save_intermediate_data(self, data: list, current_date: datetime):
-        
-        filename = f"spotify_chart_data_{current_date.strftime('%Y%m%d_%H%M')}.json"
+    def save_intermediate_data(self, fp, data: List[Dict[str, Any]]):
         
+        # 새로 수집된 행만 한 줄씩 이어 씀 (전체 데이터를 다시 쓰지 않음)
         try:
             
-            with open(filename, 'w', encoding='utf-8') as f:
-                
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            for row in data:
                 
-                logging.info(f"중간 데이터 저장 완료: {filename}")
+                fp.write(json.dumps(row, ensure_ascii=False) + '\n')
         
         except Exception as e:
             
             logging.error(f"데이터 저장 실패: {str(e)}")
     
-    @staticmethod
-    def verify_spotify_credentials(client_id: str, client_secret: str) -> bool:
+    def self_test(self) -> bool:
         
+        # 토큰 발급만으로 인증 정보를 확인하고, 발급된 토큰은 이후 수집에 그대로 사용
         try:
             
-            client_credentials_manager = SpotifyClientCredentials(
-                
-                client_id=client_id,
-                
-                client_secret=client_secret,
-                
-            )
-            
-            sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
-            
-            sp.playlist('37i9dQZEVXbNxXF4SkHj9F')
+            self.sp.auth_manager.get_access_token(as_dict=False)
             
             return True
         
@@ -212,13 +385,31 @@ class SpotifyChartHistory:
             
             return False
     
+    @classmethod
+    def verify_spotify_credentials(cls, client_id: str, client_secret: str, **kwargs) -> Optional['SpotifyChartHistory']:
+        
+        # 인증에 성공하면 수집기를 그대로 반환해 다시 인증하지 않도록 함
+        try:
+            
+            collector = cls(client_id, client_secret, **kwargs)
+        
+        except Exception as e:
+            
+            logging.error(f"인증 실패: {str(e)}")
+            
+            return None
+        
+        return collector if collector.self_test() else None
+    
 if __name__ == "__main__":
     try:
         print("Spotify API 인증 정보를 입력해주세요.")
         client_id = input("Client ID: ")
         client_secret = input("Client Secret: ")
 
-        if not SpotifyChartHistory.verify_spotify_credentials(client_id, client_secret):
+        chart_collector = SpotifyChartHistory.verify_spotify_credentials(client_id, client_secret)
+
+        if chart_collector is None:
             print("인증에 실패했습니다. Client ID와 Client Secret을 확인해주세요.")
             exit()
 
@@ -271,18 +462,20 @@ if __name__ == "__main__":
         confirm = input("\n데이터 수집을 시작하시겠습니까? (y/n): ")
 
         if confirm.lower() == 'y':
-            chart_collector = SpotifyChartHistory(client_id, client_secret)
-            charts = chart_collector.get_charts_by_period(
+            filename = f'spotify_charts_{start_date.strftime("%Y%m%d")}_{end_date.strftime("%Y%m%d")}_{interval}.csv'
+            # pyarrow가 설치된 경우 같은 데이터를 Parquet으로도 저장
+            parquet_filename = os.path.splitext(filename)[0] + '.parquet' if pa else None
+            chart_collector.get_charts_by_period(
                 start_date=start_date,
                 end_date=end_date,
-                interval=interval
+                interval=interval,
+                output_file=filename,
+                parquet_file=parquet_filename
             )
 
-            df = pd.DataFrame(charts)
-            filename = f'spotify_charts_{start_date.strftime("%Y%m%d")}_{end_date.strftime("%Y%m%d")}_{interval}.csv'
-            df.to_csv(filename, index=False, encoding='utf-8-sig')
-
             print(f"\n데이터 수집이 완료되었습니다. 파일명: {filename}")
+            if parquet_filename:
+                print(f"Parquet 파일명: {parquet_filename}")
 
         else:
             print("데이터 수집이 취소되었습니다.")
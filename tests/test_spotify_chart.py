@@ -0,0 +1,187 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+spotipy = pytest.importorskip("spotipy")
+pytest.importorskip("pandas")
+pytest.importorskip("tqdm")
+
+import spotify_chart
+from spotify_chart import SpotifyChartHistory, TokenBucket
+
+
+def test_monthly_schedule_keeps_month_end_day():
+    dates = SpotifyChartHistory.build_schedule(datetime(2024, 1, 31, 5), datetime(2024, 5, 31, 5), 'month')
+
+    assert dates == [
+        datetime(2024, 1, 31, 5),
+        datetime(2024, 2, 29, 5),
+        datetime(2024, 3, 31, 5),
+        datetime(2024, 4, 30, 5),
+        datetime(2024, 5, 31, 5),
+    ]
+
+
+def test_yearly_schedule_from_leap_day():
+    dates = SpotifyChartHistory.build_schedule(datetime(2024, 2, 29), datetime(2028, 3, 1), 'year')
+
+    assert dates == [
+        datetime(2024, 2, 29),
+        datetime(2025, 2, 28),
+        datetime(2026, 2, 28),
+        datetime(2027, 2, 28),
+        datetime(2028, 2, 29),
+    ]
+
+
+def test_hourly_schedule_includes_end_date():
+    dates = SpotifyChartHistory.build_schedule(datetime(2024, 1, 1, 0), datetime(2024, 1, 2, 0), 'hour')
+
+    assert len(dates) == 25
+    assert dates[0] == datetime(2024, 1, 1, 0)
+    assert dates[-1] == datetime(2024, 1, 2, 0)
+    assert all(type(d) is datetime for d in dates)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeSpotify:
+    def __init__(self, track_count=50, page_size=100):
+        self.track_count = track_count
+        self.page_size = page_size
+        self.calls = {'playlist_tracks': 0, 'next': 0, 'audio_features': 0, 'artists': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _page(self, offset):
+        items = [
+            {'track': {
+                'id': f't{i}',
+                'name': f'track {i}',
+                'artists': [{'id': f'a{i % 10}', 'name': f'artist {i % 10}'}],
+                'album': {'name': 'album', 'release_date': '2024-01-01', 'images': []},
+                'popularity': 50,
+            }}
+            for i in range(offset, min(offset + self.page_size, self.track_count))
+        ]
+        has_next = offset + self.page_size < self.track_count
+        return {'items': items, 'offset': offset, 'next': 'next' if has_next else None}
+
+    def playlist_tracks(self, playlist_id):
+        self._count('playlist_tracks')
+        return self._page(0)
+
+    def next(self, results):
+        self._count('next')
+        return self._page(results['offset'] + self.page_size)
+
+    def audio_features(self, track_ids):
+        self._count('audio_features')
+        # 두 작업 스레드가 동시에 캐시를 확인하도록 응답을 늦춤
+        time.sleep(0.1)
+        return [
+            {'danceability': 0.5, 'energy': 0.5, 'key': 1, 'tempo': 120.0, 'acousticness': 0.1,
+             'instrumentalness': 0.0, 'liveness': 0.1, 'valence': 0.5}
+            for _ in track_ids
+        ]
+
+    def artists(self, artist_ids):
+        self._count('artists')
+        time.sleep(0.1)
+        return {'artists': [{'id': artist_id, 'genres': ['k-pop']} for artist_id in artist_ids]}
+
+
+def make_collector(sp):
+    collector = SpotifyChartHistory('client_id', 'client_secret', max_workers=2, requests_per_second=1000, burst_size=1000)
+    collector.sp = sp
+    return collector
+
+
+def test_parallel_dates_fetch_features_and_genres_once(tmp_path):
+    sp = FakeSpotify()
+    collector = make_collector(sp)
+
+    rows = collector.get_charts_by_period(
+        datetime(2024, 1, 1, 0), datetime(2024, 1, 1, 3), 'hour',
+        output_file=str(tmp_path / 'charts.csv'),
+    )
+
+    assert rows == 4 * 50
+    assert sp.calls['playlist_tracks'] == 4
+    assert sp.calls['audio_features'] == 1
+    assert sp.calls['artists'] == 1
+
+
+def test_chart_follows_playlist_pagination():
+    sp = FakeSpotify(track_count=250)
+    collector = make_collector(sp)
+
+    chart = collector.get_chart_by_date(datetime(2024, 1, 1, 0))
+
+    assert sp.calls['next'] == 2
+    assert [row['순위'] for row in chart] == list(range(1, 251))
+    assert chart[-1]['제목'] == 'track 249'
+
+
+def test_make_api_request_raises_after_repeated_429(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(spotify_chart.time, 'sleep', clock.sleep)
+    collector = make_collector(FakeSpotify())
+    calls = []
+
+    def rate_limited():
+        calls.append(1)
+        raise spotipy.exceptions.SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '1'})
+
+    with pytest.raises(spotipy.exceptions.SpotifyException):
+        collector.make_api_request(rate_limited)
+
+    assert len(calls) == 5
+    assert len(clock.sleeps) == 4
+
+
+def test_make_api_request_gives_up_when_retry_after_exceeds_cap(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(spotify_chart.time, 'sleep', clock.sleep)
+    collector = make_collector(FakeSpotify())
+    calls = []
+
+    def rate_limited():
+        calls.append(1)
+        raise spotipy.exceptions.SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '3600'})
+
+    with pytest.raises(spotipy.exceptions.SpotifyException):
+        collector.make_api_request(rate_limited)
+
+    assert len(calls) == 1
+    assert clock.sleeps == []
+
+
+def test_token_bucket_allows_burst_then_waits_for_refill(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(spotify_chart.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(spotify_chart.time, 'sleep', clock.sleep)
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    bucket.acquire()
+    assert clock.now == pytest.approx(0.5)